@@ -2,18 +2,99 @@
 import argparse
 import json
 import os
+import random
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import asdict, astuple, dataclass
+from itertools import islice
+from requests.exceptions import RequestException
 from ytmusicapi import OAuthCredentials, YTMusic
-from typing import Dict, List, Optional
+from ytmusicapi.exceptions import YTMusicServerError
+from typing import Dict, Iterator, List, Optional
 
 from dotenv import load_dotenv
 load_dotenv()
 
+try:
+    import orjson
+except ImportError:
+    # orjson is optional, fall back to the (slower) standard library
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    # ijson is optional too, without it the whole history file is parsed in one go
+    ijson = None
+
 # CLIENT_ID = os.getenv("CLIENT_ID")
 # CLIENT_SECRET = os.getenv("CLIENT_SECRET")
 
+# Default number of searches sent to YouTube Music at the same time
+MAX_WORKERS = 10
+# Retries for a request that was rate limited or hit a server error
+MAX_RETRIES = 5
+# Below this many library uploads to match, look them up one by one instead of fetching the whole library
+UPLOADS_BULK_FETCH_THRESHOLD = 50
+# Bump whenever process_history_data changes the songs it extracts
+PARSED_HISTORY_VERSION = 4
+
+# Markers used by Takeout for the entries we care about
+TOPIC_SUFFIX = " - Topic"
+UPLOADS_CHANNEL = "Music Library Uploads"
+TITLE_PREFIX = "Watched "
+
+
+def json_loads(data: bytes):
+    """Parse JSON from bytes, using orjson when it's installed"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj, indent: bool = False) -> bytes:
+    """Serialize an object to UTF-8 encoded JSON, using orjson when it's installed"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else None)
+    if indent:
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def extract_video_id(url: str) -> str:
+    """Get the v= parameter of a watch URL, wherever it is in the query string"""
+    query = url.partition("?")[2]
+    if query.startswith("v="):
+        value = query[2:]
+    else:
+        value = query.partition("&v=")[2]
+    return value.partition("&")[0]
+
+
+@dataclass(slots=True)
+class Song:
+    """A YouTube Music song from the watch history"""
+    artistName: str
+    trackName: str
+    ts: str
+    id: str
+    isLibraryUpload: bool
+    albumName: Optional[str] = None
+
+    def to_output(self) -> Dict:
+        """The fields written to the output files, albumName only if one was found"""
+        output = {"artistName": self.artistName, "trackName": self.trackName, "ts": self.ts}
+        if self.albumName is not None:
+            output["albumName"] = self.albumName
+        return output
+
 
 class YouTubeMusicHistoryProcessor:
-    def __init__(self):
+    def __init__(self, pretty_output: bool = False, max_workers: int = MAX_WORKERS,
+                 max_requests_per_minute: Optional[int] = None):
 
         if not os.path.exists("oauth.json"):
             self.authenticated = False
@@ -23,10 +104,23 @@ class YouTubeMusicHistoryProcessor:
             self.ytmusic = YTMusic("oauth.json", oauth_credentials=OAuthCredentials(client_id=os.getenv("CLIENT_ID"), client_secret=os.getenv("CLIENT_SECRET")))
         # self.ytmusic = YTMusic(browser_auth_file)
         self.watch_history_file = "watch-history.json"
-        self.cache_file = "api_cache.json"
-        self.library_uploads_cache = None
-        self.queried_ids = set()
+        self.pretty_output = pretty_output
+        self.max_workers = max_workers
+        self.parsed_history_file = "parsed_history.json"
+        self.history_read_failed = False
+        self.cache_file = "api_cache.jsonl"
+        self.legacy_cache_file = "api_cache.json"
+        self.cache_fp = None
+        self.cache_lock = threading.Lock()
+        self.cache_load_failed = False
+        self.library_uploads_file = "library_uploads.json"
+        self.uploads_by_id = None
+        self.lookup_uploads_individually = False
         self.successful_api_count = 0
+        self.api_lock = threading.Lock()
+        # Optional cap on requests within any 60 second window, otherwise only 429s slow us down
+        self.max_requests_per_minute = max_requests_per_minute
+        self.request_times = deque()
         self.songs = []
         self.api_cache = {}
         self.load_cache()
@@ -34,283 +128,523 @@ class YouTubeMusicHistoryProcessor:
     def load_cache(self):
         """Load the API cache from file if it exists"""
         try:
+            compact = False
             if os.path.exists(self.cache_file):
-                with open(self.cache_file, "r", encoding="utf-8") as file:
-                    self.api_cache = json.load(file)
-                print(f"Loaded cache with {len(self.api_cache)} entries")
-                # Load previously queried IDs
-                self.queried_ids = set(self.api_cache.keys())
+                with open(self.cache_file, "rb") as file:
+                    for line in file:
+                        try:
+                            self.api_cache.update(json_loads(line))
+                        except ValueError:
+                            # Skip entries left half-written by an interrupted run (bad JSON, or UTF-8
+                            # cut mid-character), and rewrite the file so new entries aren't appended
+                            # onto the unterminated line
+                            compact = True
+            elif os.path.exists(self.legacy_cache_file):
+                with open(self.legacy_cache_file, "rb") as file:
+                    self.api_cache = json_loads(file.read())
+                # Migrate the old single-document cache to the append-only format
+                compact = True
+            else:
+                return
+
+            # Library uploads used to be cached alongside the songs, move them to their own file
+            legacy_uploads = self.api_cache.pop("library_uploads", None)
+            if legacy_uploads is not None:
+                if not os.path.exists(self.library_uploads_file):
+                    self.save_library_uploads(self.index_library_uploads(legacy_uploads))
+                compact = True
+
+            # Only rewrite the cache file once the uploads are out of it
+            if compact:
+                self.save_cache()
+
+            print(f"Loaded cache with {len(self.api_cache)} entries")
         except Exception as e:
             print(f"Error loading cache file: {e}")
             self.api_cache = {}
+            self.cache_load_failed = True
+
+    def cache_entry(self, key: str, value):
+        """Store an entry in the API cache and append it to the cache file"""
+        with self.cache_lock:
+            self.api_cache[key] = value
+            try:
+                if self.cache_fp is None:
+                    self.cache_fp = open(self.cache_file, "ab")
+                self.cache_fp.write(json_dumps({key: value}) + b"\n")
+                self.cache_fp.flush()
+            except Exception as e:
+                print(f"Error writing cache file: {e}")
 
     def save_cache(self):
-        """Save the current API cache to file"""
+        """Compact the API cache file down to one line per entry"""
         try:
-            with open(self.cache_file, "w", encoding="utf-8") as file:
-                json.dump(self.api_cache, file, indent=2, ensure_ascii=False)
+            if self.cache_fp is not None:
+                self.cache_fp.close()
+                self.cache_fp = None
+            if self.cache_load_failed:
+                # Compacting would replace the entries we couldn't load with only this run's ones
+                return
+            temp_file = self.cache_file + ".tmp"
+            with open(temp_file, "wb") as file:
+                for key, value in self.api_cache.items():
+                    file.write(json_dumps({key: value}) + b"\n")
+            os.replace(temp_file, self.cache_file)
             # print(f"Saved API cache with {len(self.api_cache)} entries")
         except Exception as e:
             print(f"Error saving cache file: {e}")
 
-    def read_watch_history(self) -> List[Dict]:
-        """Read and parse the YouTube Music watch history file"""
+    def wait_for_request_slot(self):
+        """Block until another request fits in the per-minute request budget, if one was set"""
+        if not self.max_requests_per_minute:
+            return
+        while True:
+            with self.api_lock:
+                now = time.monotonic()
+                while self.request_times and now - self.request_times[0] >= 60:
+                    self.request_times.popleft()
+                if len(self.request_times) < self.max_requests_per_minute:
+                    self.request_times.append(now)
+                    return
+                delay = 60 - (now - self.request_times[0])
+            time.sleep(delay)
+
+    @staticmethod
+    def is_retryable(error: Exception) -> bool:
+        """Check if a failed request is worth retrying (rate limits, server errors, network issues)"""
+        if isinstance(error, RequestException):
+            return True
+        message = str(error)
+        return "HTTP 429" in message or "HTTP 5" in message
+
+    def call_api(self, method, *args, **kwargs):
+        """Call a YTMusic method, backing off exponentially while YouTube refuses the request"""
+        for attempt in range(MAX_RETRIES + 1):
+            self.wait_for_request_slot()
+            try:
+                result = method(*args, **kwargs)
+            except (YTMusicServerError, RequestException) as e:
+                if attempt == MAX_RETRIES or not self.is_retryable(e):
+                    raise
+
+                # Honour Retry-After when the response is available, otherwise use full jitter
+                response = getattr(e, "response", None)
+                retry_after = response.headers.get("Retry-After", "") if response is not None else ""
+                delay = float(retry_after) if retry_after.isdigit() else random.uniform(0, 2 ** (attempt + 1))
+                print(f"Request failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+
+            with self.api_lock:
+                self.successful_api_count += 1
+            return result
+
+    def read_watch_history(self) -> Iterator[Dict]:
+        """Stream the entries of the YouTube Music watch history file one at a time"""
         print("\nReading YouTube Music history from watch-history.json\n")
+        # json.JSONDecodeError is a ValueError, ijson.JSONError isn't
+        read_errors = (IOError, ValueError) if ijson is None else (IOError, ValueError, ijson.JSONError)
+        self.history_read_failed = False
         try:
-            with open(self.watch_history_file, "r", encoding="utf-8") as file:
-                return json.load(file)
-        except (IOError, json.JSONDecodeError) as e:
+            with open(self.watch_history_file, "rb") as file:
+                if ijson is None:
+                    yield from json_loads(file.read())
+                else:
+                    yield from ijson.items(file, "item")
+        except read_errors as e:
             print(f"Error reading watch history file: {e}")
-            return []
+            self.history_read_failed = True
 
-    def extract_artist_name(self, item: Dict) -> Optional[str]:
-        """Extract artist name from item subtitles"""
-        if not item.get("subtitles"):
+    def history_cache_key(self) -> Optional[str]:
+        """Identify the current watch history file by its modification time and size"""
+        try:
+            stat = os.stat(self.watch_history_file)
+        except OSError:
             return None
-            
+        return f"{PARSED_HISTORY_VERSION}-{stat.st_mtime_ns}-{stat.st_size}"
+
+    def load_parsed_history(self, key: str) -> bool:
+        """Load the songs parsed on a previous run if the watch history hasn't changed since"""
         try:
-            if isinstance(item["subtitles"], list) and item["subtitles"]:
-                return item["subtitles"][0].get("name", "")
-            elif isinstance(item["subtitles"], dict):
-                return item["subtitles"].get("name", "")
-            else:
-                subtitles_str = json.dumps(item.get("subtitles"))
-                if "," in subtitles_str:
-                    return subtitles_str.split(",")[0][10:-1]
+            if not os.path.exists(self.parsed_history_file):
+                return False
+            with open(self.parsed_history_file, "rb") as file:
+                parsed = json_loads(file.read())
+            if parsed.get("key") != key:
+                return False
+            self.songs = [
+                Song(sys.intern(artist), title, timestamp, sys.intern(song_id), is_upload)
+                for artist, title, timestamp, song_id, is_upload, _ in parsed["songs"]
+            ]
+            return True
         except Exception as e:
-            print(f"Error parsing subtitle: {e}")
-            print(f"Subtitle content: {item.get('subtitles')}")
-        
-        return None
+            print(f"Error loading parsed history file: {e}")
+            return False
 
-    def process_history_data(self):
-        """Parse the YouTube Music watch history and extract relevant song information"""
-        parsed_data = self.read_watch_history()
-        
-        for item in parsed_data:
-            if item.get("header") != "YouTube Music":
-                continue
-                
-            raw_artist = self.extract_artist_name(item)
-            if not raw_artist:
-                continue
-                
-            # Only process Topic channels or Library Uploads
-            if " - Topic" not in raw_artist and "Music Library Uploads" not in raw_artist:
-                continue
-                
-            # Process valid music entry
-            artist = raw_artist[:-8] if " - Topic" in raw_artist else raw_artist
-            artist = artist.replace('\\"', '"').replace('\\\"', '"')  # Clean quotes
-            
-            title = item.get("title", "").replace("Watched ", "")
-            song_id = item.get("titleUrl", "").split("=")[-1] if item.get("titleUrl") else ""
-            timestamp = item.get("time", "")
+    def save_parsed_history(self, key: str):
+        """Save the parsed songs so the next run can skip parsing the watch history"""
+        try:
+            with open(self.parsed_history_file, "wb") as file:
+                file.write(json_dumps({"key": key, "songs": [astuple(song) for song in self.songs]}))
+        except Exception as e:
+            print(f"Error saving parsed history file: {e}")
+
+    def extract_song(self, item: Dict) -> Optional[Song]:
+        """Extract a song from a watch history entry, None if it isn't a YouTube Music song"""
+        # Cheapest check first, most of the history is regular YouTube
+        if item.get("header") != "YouTube Music":
+            return None
+
+        subtitles = item.get("subtitles")
+        if not subtitles:
+            return None
+
+        # Takeout gives a list of subtitles, older exports a single one
+        subtitle = subtitles[0] if type(subtitles) is list else subtitles
+        if type(subtitle) is not dict:
+            print(f"Unexpected subtitle format: {subtitles}")
+            return None
+
+        raw_artist = subtitle.get("name")
+        if not raw_artist:
+            return None
             
-            song = {
-                "artistName": artist,
-                "trackName": title,
-                "ts": timestamp,
-                "id": song_id,
-                "isLibraryUpload": "Music Library Uploads" in raw_artist
-            }
+        # Only process Topic channels or Library Uploads, both are always at the end of the name
+        is_topic = raw_artist.endswith(TOPIC_SUFFIX)
+        is_upload = not is_topic and raw_artist.endswith(UPLOADS_CHANNEL)
+        if not (is_topic or is_upload):
+            return None
             
-            self.songs.append(song)
+        # Process valid music entry
+        artist = raw_artist[:-len(TOPIC_SUFFIX)] if is_topic else raw_artist
+        if "\\" in artist:
+            artist = artist.replace('\\"', '"')  # Clean quotes
+        
+        title = item.get("title", "").removeprefix(TITLE_PREFIX)
+        song_id = extract_video_id(item.get("titleUrl") or "")
+        timestamp = item.get("time", "")
         
+        # Replays and other songs by the same artist share one string instead of a copy per play
+        return Song(sys.intern(artist), title, timestamp, sys.intern(song_id), is_upload)
+
+    def process_history_data(self, limit: Optional[int] = None):
+        """Parse the YouTube Music watch history and extract relevant song information"""
+        history_key = self.history_cache_key()
+        if history_key and self.load_parsed_history(history_key):
+            if limit:
+                self.songs = self.songs[:limit]
+            print(f"Found {len(self.songs)} YouTube Music songs in watch-history.json (already parsed)")
+            return
+
+        songs = filter(None, map(self.extract_song, self.read_watch_history()))
+        # Stop reading once we have enough songs, the rest of the file isn't needed
+        self.songs = list(islice(songs, limit or None))
+
+        # Only a complete parse can be reused by later runs, not one cut short by the limit or a read error
+        complete = not self.history_read_failed and not (limit and len(self.songs) >= limit)
+        if history_key and complete and self.songs:
+            self.save_parsed_history(history_key)
         print(f"Found {len(self.songs)} YouTube Music songs in watch-history.json")
 
-    def get_library_uploads(self) -> List[Dict]:
-        """Fetch all library uploads from the YouTube Music account"""
+    def get_library_uploads(self) -> Dict[str, Dict]:
+        """Fetch all library uploads from the YouTube Music account, indexed by videoId"""
+
+        if self.uploads_by_id is not None:
+            return self.uploads_by_id
 
         if not self.authenticated:
             print("""WARNING: You're not authenticated but library uploads were found in the watch history, 
                     consider authenticating to get all possible entries, skipping library uploads""")
-            return []
+            self.uploads_by_id = {}
+            return self.uploads_by_id
 
-        if self.library_uploads_cache is not None:
-            return self.library_uploads_cache
-        
-        cache_key = "library_uploads"
-        if cache_key in self.api_cache:
-            self.library_uploads_cache = self.api_cache[cache_key]
-            print(f"Using cached library uploads ({len(self.library_uploads_cache)} items)")
-            return self.library_uploads_cache
+        if os.path.exists(self.library_uploads_file):
+            try:
+                with open(self.library_uploads_file, "rb") as file:
+                    self.uploads_by_id = json_loads(file.read())
+                print(f"Using cached library uploads ({len(self.uploads_by_id)} items)")
+                return self.uploads_by_id
+            except Exception as e:
+                print(f"Error loading library uploads file: {e}")
 
         print("Fetching all library uploads...")
         try:
-            self.library_uploads_cache = self.ytmusic.get_library_upload_songs(limit=None)
-            self.successful_api_count += 1
-            print(f"Successfully fetched {len(self.library_uploads_cache)} library uploads")
-            
-            # Save to cache
-            self.api_cache[cache_key] = self.library_uploads_cache
-            self.save_cache()
+            uploads = self.call_api(self.ytmusic.get_library_upload_songs, limit=None)
+            print(f"Successfully fetched {len(uploads)} library uploads")
 
-            return self.library_uploads_cache
+            self.uploads_by_id = self.index_library_uploads(uploads)
+            self.save_library_uploads(self.uploads_by_id)
+
+            return self.uploads_by_id
         except Exception as e:
             print(f"Error fetching library uploads: {e}")
-            return []
+            return {}
 
-    def find_upload_match(self, id: str) -> Optional[Dict]:
-        """Search through library uploads to find a matching song"""
-        uploads = self.get_library_uploads()
-        
-        # Normalize search terms for better matching
-        
+    def save_library_uploads(self, uploads_by_id: Dict[str, Dict]):
+        """Save the indexed library uploads so they don't have to be fetched again"""
+        try:
+            with open(self.library_uploads_file, "wb") as file:
+                file.write(json_dumps(uploads_by_id))
+        except Exception as e:
+            print(f"Error saving library uploads file: {e}")
+
+    @staticmethod
+    def index_library_uploads(uploads: List[Dict]) -> Dict[str, Dict]:
+        """Index the album and artist of each library upload by videoId, normalized once up front"""
+        uploads_by_id = {}
         for upload in uploads:
-            # Extract upload artist and title for comparison
-            # upload_artist = upload.get('artists', [{}])[0].get('name', '').lower() if upload.get('artists') else ''
-            # upload_title = upload.get('title', '').lower()
-            
-            # Check for match (flexible matching for slight naming differences)
-            if id == upload.get('videoId'):
-                
-                # Get artist name from the upload if available
-                actual_artist = upload.get('artists', [{}])[0].get('name', '') if upload.get('artists') else 'Unknown'
-                
-                # Extract album name correctly based on the structure
-                album_name = ''
-                if isinstance(upload.get('album'), dict):
-                    album_name = upload.get('album', {}).get('name', '')
-                else:
-                    album_name = upload.get('album', '')
-                    
-                return {
-                    'albumName': album_name,
-                    'videoId': upload.get('videoId', ''),
-                    'artistName': actual_artist
-                }
-        
-        return None
+            video_id = upload.get('videoId')
+            if not video_id:
+                continue
+
+            # Get artist name from the upload if available
+            actual_artist = upload.get('artists', [{}])[0].get('name', '') if upload.get('artists') else 'Unknown'
+
+            # Extract album name correctly based on the structure
+            album_name = ''
+            if isinstance(upload.get('album'), dict):
+                album_name = upload.get('album', {}).get('name', '')
+            else:
+                album_name = upload.get('album', '')
+
+            uploads_by_id[video_id] = {
+                'albumName': album_name,
+                'videoId': video_id,
+                'artistName': actual_artist
+            }
+        return uploads_by_id
+
+    def find_upload_match(self, id: str) -> Optional[Dict]:
+        """Look up a library upload matching the given videoId"""
+        return self.get_library_uploads().get(id)
 
-    def process_library_upload(self, song: Dict, index: int) -> bool:
+    def process_library_upload(self, song: Song, index: int) -> bool:
         """Process a library upload song to find album info"""
-        upload_match = self.find_upload_match(song['id'])
+        upload_match = None
+        if self.lookup_uploads_individually and song.id:
+            try:
+                upload_match = self.lookup_upload(song.id)
+            except Exception as e:
+                print(f"Error looking up upload {song.id}, using the upload library instead: {e!r}")
+        # Without an album the individual result is only a last resort, the upload library usually has it
+        if not (upload_match and upload_match['albumName']):
+            upload_match = self.find_upload_match(song.id) or upload_match
+            if self.uploads_by_id is not None:
+                # The whole library is loaded now, no need for any more individual lookups
+                self.lookup_uploads_individually = False
         if not upload_match:
             return False
             
-        self.songs[index]['albumName'] = upload_match['albumName']
-        self.songs[index]['artistName'] = upload_match['artistName']
+        self.songs[index].albumName = upload_match['albumName']
+        self.songs[index].artistName = upload_match['artistName']
         
         return True
 
-    def process_regular_song(self, song: Dict, index: int) -> bool:
+    @staticmethod
+    def album_info_from_track(track: Dict) -> Optional[Dict]:
+        """Extract the album (and artist) of a track returned by the API"""
+        if not track.get('album'):
+            return None
+
+        album_info = {'albumName': track['album']['name']}
+        if track.get('artists'):
+            album_info['artistName'] = track['artists'][0]['name']
+        return album_info
+
+    def watch_track(self, video_id: str) -> Optional[Dict]:
+        """Fetch the track info of a video directly by its id"""
+        watch_playlist = self.call_api(self.ytmusic.get_watch_playlist, videoId=video_id, limit=1)
+        tracks = watch_playlist.get('tracks') or []
+        # The first track of the watch playlist is the video itself
+        if not tracks or tracks[0].get('videoId') != video_id:
+            return None
+        return tracks[0]
+
+    def lookup_video(self, video_id: str) -> Optional[Dict]:
+        """Look up the album of a video directly by its id"""
+        track = self.watch_track(video_id)
+        return self.album_info_from_track(track) if track else None
+
+    def lookup_upload(self, video_id: str) -> Optional[Dict]:
+        """Look up the album and artist of a library upload by its id, shaped like an upload index entry"""
+        track = self.watch_track(video_id)
+        if not track or not (track.get('album') or track.get('artists')):
+            return None
+
+        # Same defaults as index_library_uploads, the artist is kept even without an album
+        return {
+            'albumName': track['album']['name'] if track.get('album') else '',
+            'videoId': video_id,
+            'artistName': track['artists'][0]['name'] if track.get('artists') else 'Unknown'
+        }
+
+    def search_song(self, search_query: str) -> Optional[Dict]:
+        """Search for a song by artist and title and take the album of the best match"""
+        search_results = self.call_api(self.ytmusic.search, search_query, filter="songs", limit=1)
+        if not search_results:
+            return None
+        return self.album_info_from_track(search_results[0])
+
+    def process_regular_song(self, song: Song, index: int) -> bool:
         """Process a regular (non-library) song to find album info"""
-        search_query = f"{song['artistName']} - {song['trackName']}"
-        
-        # Check cache for this query
-        song_id = song.get('id', '')
-        if song_id and song_id in self.api_cache:
-            cached_data = self.api_cache[song_id]
-            if 'albumName' in cached_data:
-                self.songs[index]['albumName'] = cached_data['albumName']
-                return True
+        search_query = f"{song.artistName} - {song.trackName}"
         
+        # Different videos of the same song make the same search, so results are cached by query too
+        search_key = f"search:{search_query.lower()}"
+        album_info = self.api_cache.get(search_key)
+        if album_info is None:
+            # The video id gives an exact match, only search when it doesn't have an album
+            if song.id:
+                try:
+                    album_info = self.lookup_video(song.id)
+                except Exception as e:
+                    # Removed or unavailable videos can fail in many ways, the search may still find the song
+                    print(f"Error looking up video {song.id}, searching instead: {e!r}")
+            if album_info is None:
+                album_info = self.search_song(search_query)
+            if album_info is None:
+                return False
+            self.cache_entry(search_key, album_info)
 
-        
-        search_results = self.ytmusic.search(search_query, filter="songs", limit=1)
-        self.successful_api_count += 1
-        
-        if search_results and 'album' in search_results[0]:
-            album_name = search_results[0]['album']['name']
-            self.songs[index]['albumName'] = album_name
+        self.songs[index].albumName = album_info['albumName']
 
-            # Special case for Release (Some songs don't have and artist page so they are listed as "Release" in the watch history)
-            if song['artistName'] == "Release" and 'artists' in search_results[0]:
-                self.songs[index]['artistName'] = search_results[0]['artists'][0]['name']
-            
-            # Cache the result
-            if song_id:
-                self.api_cache[song_id] = {
-                    'albumName': album_name,
-                    'artistName': song.get('artistName', '')
-                }
-                # Save cache periodically (every 10 API calls)
-                if self.successful_api_count % 10 == 0:
-                    self.save_cache()
-                    
-            return True
-            
-        return False
+        # Special case for Release (Some songs don't have and artist page so they are listed as "Release" in the watch history)
+        if song.artistName == "Release" and 'artistName' in album_info:
+            self.songs[index].artistName = album_info['artistName']
+
+        return True
+
+    def apply_cached_info(self, index: int) -> bool:
+        """Copy previously fetched album info onto a song, if there is any"""
+        song = self.songs[index]
+        cached_data = self.api_cache.get(song.id) if song.id else None
+        if cached_data is None:
+            return False
+
+        if 'albumName' in cached_data:
+            song.albumName = cached_data['albumName']
+        if 'artistName' in cached_data:
+            song.artistName = cached_data['artistName']
+        return True
+
+    def record_result(self, index: int, success: bool):
+        """Record a successful lookup in the cache so it isn't queried again"""
+        song = self.songs[index]
+        if success and song.id:
+            self.cache_entry(song.id, {
+                'albumName': song.albumName or '',
+                'artistName': song.artistName
+            })
+
+    def group_songs_by_id(self) -> Dict:
+        """Group the indices of songs sharing an id so each song is only looked up once"""
+        groups = {}
+        for i, song in enumerate(self.songs):
+            # Songs without an id can't be matched to each other, keep them on their own
+            groups.setdefault(song.id or i, []).append(i)
+        return groups
+
+    def share_result(self, indices: List[int]):
+        """Copy the info found for the first occurrence of a song to its repeats"""
+        first = self.songs[indices[0]]
+        for i in indices[1:]:
+            if first.albumName is not None:
+                self.songs[i].albumName = first.albumName
+            self.songs[i].artistName = first.artistName
 
     def fetch_album_info(self):
         """Fetch album information for all songs"""
-        print(f"Processing all {len(self.songs)} songs")
+        groups = self.group_songs_by_id()
+        print(f"Processing all {len(self.songs)} songs ({len(groups)} unique)")
         completed_items = 0
-        
-        for i, song in enumerate(self.songs):
-            song_id = song.get('id', '')
-            
+
+        # Fetching the whole upload library only pays off when there are enough uploads to match
+        uncached_uploads = sum(
+            1 for indices in groups.values()
+            if self.songs[indices[0]].isLibraryUpload and self.songs[indices[0]].id not in self.api_cache
+        )
+        self.lookup_uploads_individually = (
+            self.authenticated
+            and self.uploads_by_id is None
+            and uncached_uploads < UPLOADS_BULK_FETCH_THRESHOLD
+            and not os.path.exists(self.library_uploads_file)
+        )
+
+        def report_progress():
+            # Show progress periodically
+            if completed_items % 10 == 0 or completed_items == len(groups):
+                print(f"Progress: {completed_items}/{len(groups)} "
+                      f"({self.successful_api_count} API Requests)")
+
+        # Library uploads are matched locally, regular songs are queued for searching
+        pending = []
+        for indices in groups.values():
+            i = indices[0]
+            song = self.songs[i]
+
             # Check if we already have info for this ID
-            if song_id and song_id in self.queried_ids and song_id in self.api_cache:
-                # Reuse the cached album info
-                cached_data = self.api_cache[song_id]
-                if 'albumName' in cached_data:
-                    self.songs[i]['albumName'] = cached_data['albumName']
-                if 'artistName' in cached_data:
-                    self.songs[i]['artistName'] = cached_data['artistName']
+            if self.apply_cached_info(i):
+                self.share_result(indices)
                 completed_items += 1
+                report_progress()
                 continue
-            
-            success = False
+
+            if not song.isLibraryUpload:
+                pending.append(indices)
+                continue
+
             try:
-                # Process based on song type
-                if song.get('isLibraryUpload', False):
-                    success = self.process_library_upload(song, i)
-                else:
-                    success = self.process_regular_song(song, i)
-                
-                # Update successful count and record queried ID
-                if success and song_id:
-                    self.queried_ids.add(song_id)
-                    self.api_cache[song_id] = {
-                        'albumName': song.get('albumName', ''),
-                        'artistName': song.get('artistName', '')
-                    }
-                    
-                    # Save cache periodically (every 10 completed items)
-                    # if completed_items % 10 == 0:
-                    #     self.save_cache()
-                    
+                self.record_result(i, self.process_library_upload(song, i))
             except Exception as e:
                 print(f"Error processing item {i}: {e}")
-                # Save cache on error to preserve progress
-                self.save_cache()
-            
+            self.share_result(indices)
             completed_items += 1
-            
-            # Show progress periodically
-            if completed_items % 10 == 0 or completed_items == len(self.songs):
-                print(f"Progress: {completed_items}/{len(self.songs)} "
-                      f"({self.successful_api_count} API Requests)")
-        
-        # Final cache save before finalizing data
+            report_progress()
+
+        # Searches are network bound, so run several of them at once
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                executor.submit(self.process_regular_song, self.songs[indices[0]], indices[0]): indices
+                for indices in pending
+            }
+            for future in as_completed(futures):
+                indices = futures[future]
+                try:
+                    self.record_result(indices[0], future.result())
+                except Exception as e:
+                    print(f"Error processing item {indices[0]}: {e}")
+                self.share_result(indices)
+                completed_items += 1
+                report_progress()
+
+        # Compact the cache file before finalizing data
         self.save_cache()
         self.finalize_data()
 
     def finalize_data(self):
         """Finalize the data and write it to disk"""
         print(f"Finished with {self.successful_api_count} successful API requests.")
-        
-        # Remove temporary fields from each item
-        for song in self.songs:
-            song.pop('id', None)
-            song.pop('isLibraryUpload', None)
-        
         self.write_output_files()
     
+    def write_json_file(self, file_name: str, songs: List[Song]):
+        """Write a list of songs to a JSON file, indented only if pretty output was requested"""
+        with open(file_name, "wb") as file:
+            file.write(json_dumps([song.to_output() for song in songs], indent=self.pretty_output))
+
     def write_output_files(self):
         """Write the processed data to output files"""
         # Write file(s) based on size
         if len(self.songs) < 2800:
-            with open("formatted.json", "w", encoding="utf-8") as file:
-                json.dump(self.songs, indent=2, ensure_ascii=False, fp=file)
+            self.write_json_file("formatted.json", self.songs)
         else:
             chunk_size = 2800
-            for i, chunk_start in enumerate(range(0, len(self.songs), chunk_size)):
-                chunk = self.songs[chunk_start:chunk_start + chunk_size]
-                with open(f"formatted-{i+1}.json", "w", encoding="utf-8") as file:
-                    json.dump(chunk, indent=2, ensure_ascii=False, fp=file)
+            chunks = [
+                (f"formatted-{i+1}.json", self.songs[chunk_start:chunk_start + chunk_size])
+                for i, chunk_start in enumerate(range(0, len(self.songs), chunk_size))
+            ]
+            # Serialize and write the chunks in parallel
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                list(executor.map(lambda chunk: self.write_json_file(*chunk), chunks))
         
         print("\nFinished Successfully, final file(s) written to formatted.json")
         print("Download and open Last.FM-Scrubbler-WPF")
@@ -320,29 +654,47 @@ class YouTubeMusicHistoryProcessor:
 
     def write_test_file(self):
         """Write intermediate test file with current data"""
-        with open("formatted-test.json", "w", encoding="utf-8", errors="replace") as file:
-            json.dump(self.songs, indent=2, ensure_ascii=False, fp=file)
+        with open("formatted-test.json", "wb") as file:
+            file.write(json_dumps([asdict(song) for song in self.songs]))
         print("Test file written to formatted-test.json")
 
+def non_negative_int(value: str) -> int:
+    """argparse type for counts that can't be negative"""
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"must be 0 or more, got {value}")
+    return number
+
+def positive_int(value: str) -> int:
+    """argparse type for counts that need to be at least 1"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be 1 or more, got {value}")
+    return number
+
 def main():
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='Process YouTube Music watch history')
-    parser.add_argument('--limit', type=int, help='Limit the number of songs to process')
+    parser.add_argument('--limit', type=non_negative_int, help='Limit the number of songs to process')
     # parser.add_argument('--no-album', action='store_true', help='Do not fetch album information')
     parser.add_argument('--only-uploads', action='store_true', help='Only process library uploads')
     parser.add_argument('--test-mode', action='store_true', help='Run in test mode (limit to 500 songs)')
+    parser.add_argument('--test-file', action='store_true', help='Write the parsed songs to formatted-test.json before fetching albums')
+    parser.add_argument('--pretty', action='store_true', help='Indent the output JSON files for readability')
+    parser.add_argument('--workers', type=positive_int, default=MAX_WORKERS,
+                        help=f'Number of searches to run at the same time (default {MAX_WORKERS})')
+    parser.add_argument('--max-requests-per-minute', type=non_negative_int,
+                        help='Cap the number of API requests sent per minute (default or 0 means no cap, only back off on rate limits)')
     args = parser.parse_args()
 
     # Create processor and process data
-    processor = YouTubeMusicHistoryProcessor()
-    processor.process_history_data()
+    processor = YouTubeMusicHistoryProcessor(pretty_output=args.pretty, max_workers=args.workers,
+                                             max_requests_per_minute=args.max_requests_per_minute)
+    processor.process_history_data(limit=args.limit)
 
     # Apply filters
-    if args.limit:
-        processor.songs = processor.songs[:args.limit]
-    
     if args.only_uploads:
-        processor.songs = [song for song in processor.songs if song.get('isLibraryUpload', False)]
+        processor.songs = [song for song in processor.songs if song.isLibraryUpload]
 
     # Apply test mode limit
     if args.test_mode:
@@ -350,7 +702,8 @@ def main():
         print("Running in test mode - limited to 500 songs")
 
     # Write test file with data so far
-    # processor.write_test_file()
+    if args.test_file or args.test_mode:
+        processor.write_test_file()
 
     processor.fetch_album_info()
 